@@ -12,6 +12,8 @@ import datetime as dt
 import itertools
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import h5py
 import numpy as np
@@ -145,6 +147,244 @@ DSET_UNIT_DICT = {
 }
 
 
+##------------------ Utility Functions --------------------##
+
+def _open_h5(fname, mode='r'):
+    """Open HDF5 file with enlarged metadata cache and raw data chunk cache.
+
+    The default metadata cache (2 MB) is small for files with many datasets / chunks,
+    e.g. ifgramStack with hundreds of interferograms, resulting in repeated B-tree lookups.
+    The metadata cache is fixed to 128 MB (no automatic resizing), and the raw data chunk
+    cache of each dataset is enlarged from the default 1 MB to 64 MB for big 2D/3D datasets.
+
+    New files are created with the HDF5 1.10+ file format, for the v2 B-tree and the
+    constant-time chunk indexing of datasets. Files are read in SWMR mode if supported,
+    to skip the file locking and metadata re-locking.
+
+    Parameters: fname - str, path of the HDF5 file
+                mode  - str, file mode, e.g. r, r+, w
+    Returns:    f     - h5py.File object
+    """
+    kwargs = dict(rdcc_nbytes=64*1024**2, rdcc_nslots=521, rdcc_w0=0.75)
+    if mode == 'w':
+        f = h5py.File(fname, mode, libver=('v110', 'latest'), **kwargs)
+    elif mode == 'r':
+        try:
+            f = h5py.File(fname, mode, swmr=True, **kwargs)
+        except (OSError, ValueError):
+            # older HDF5 library requires the latest file format for SWMR read
+            f = h5py.File(fname, mode, **kwargs)
+    else:
+        f = h5py.File(fname, mode, **kwargs)
+
+    mdc_size = 128 * 1024**2
+    mdc_config = f.id.get_mdc_config()
+    mdc_config.set_initial_size = True
+    mdc_config.initial_size = mdc_size
+    mdc_config.min_size = mdc_size
+    mdc_config.max_size = mdc_size
+    f.id.set_mdc_config(mdc_config)
+    return f
+
+
+def _date_list2datetime64(date_list, date_format):
+    """Convert list of date strings into array of np.datetime64 objects.
+
+    Dates in YYYYMMDD format are parsed with vectorized integer arithmetic,
+    instead of calling datetime.strptime() for each date.
+
+    Parameters: date_list   - list / 1D np.ndarray of str, dates
+                date_format - str, date string format, e.g. %Y%m%d
+    Returns:    times       - 1D np.ndarray of datetime64[us]
+    """
+    if date_format == '%Y%m%d':
+        dates = np.asarray(date_list).astype(np.int64)
+        years = (dates // 10000 - 1970).astype('datetime64[Y]')
+        months = years.astype('datetime64[M]') + (dates // 100 % 100 - 1)
+        times = months.astype('datetime64[D]') + (dates % 100 - 1)
+    else:
+        times = np.array([dt.datetime.strptime(i, date_format) for i in date_list], dtype='datetime64[us]')
+    return times.astype('datetime64[us]')
+
+
+def _decode_dates(dates):
+    """Decode array of dates in bytes into array of str in one vectorized call,
+    instead of creating a Python str for each date via bytes.decode().
+
+    Parameters: dates - np.ndarray of bytes, e.g. the date dataset in HDF5 file
+    Returns:    dates - np.ndarray of str in the same shape
+    """
+    return np.char.decode(np.ascontiguousarray(dates, dtype=np.bytes_), 'utf8')
+
+
+def _get_step_size(dset, box=None, max_memory=0.5):
+    """Get the number of slices in the 1st dimension to read at once from a 3D dataset.
+
+    The step size is aligned with the chunk size in the 1st dimension (if chunked),
+    so that each chunk is read and decompressed only once, while the memory usage
+    of each block is limited.
+
+    Parameters: dset       - h5py.Dataset object in 3D
+                box        - tuple of 4 int, (x0, y0, x1, y1) of the area to read
+                max_memory - float, max memory to use for each block in GB
+    Returns:    step       - int, number of slices to read at once
+    """
+    if box is None:
+        box = (0, 0, dset.shape[2], dset.shape[1])
+    slice_size = (box[2] - box[0]) * (box[3] - box[1]) * dset.dtype.itemsize
+    step = max(int(max_memory * 1024**3 / slice_size), 1)
+
+    # align with the chunk size
+    if dset.chunks:
+        step = max(step // dset.chunks[0], 1) * dset.chunks[0]
+    return min(step, dset.shape[0])
+
+
+def _clip_box(box, length, width):
+    """Clip the box to the extent of the 2D array in the same way as NumPy / h5py slicing,
+    e.g. data[y0:y1, x0:x1], for the box beyond the extent or with negative values.
+
+    Parameters: box    - tuple of 4 int, (x0, y0, x1, y1)
+                length - int, number of rows of the 2D array
+                width  - int, number of columns of the 2D array
+    Returns:    box    - tuple of 4 int, (x0, y0, x1, y1) with x0 <= x1 and y0 <= y1
+    """
+    x0, x1 = slice(box[0], box[2]).indices(width)[:2]
+    y0, y1 = slice(box[1], box[3]).indices(length)[:2]
+    return (x0, y0, max(x0, x1), max(y0, y1))
+
+
+def _read_hyperslab(dset, inds, box=None, dtype=None):
+    """Read slices at the given indices in the 1st dimension within the box from a 3D dataset,
+    or elements at the given indices from a 1D dataset.
+
+    The indices are grouped into runs of consecutive values, and each run is read as one
+    hyperslab directly into its slice of the pre-allocated output array, to avoid the slow
+    fancy indexing of h5py and the per-slice read overhead.
+
+    Parameters: dset  - h5py.Dataset object in 3D, or in 1D if box is None
+                inds  - 1D np.ndarray of int, sorted indices in the 1st dimension
+                box   - tuple of 4 int, (x0, y0, x1, y1) in the 2nd/3rd dimension,
+                        clipped to the dataset extent as in NumPy slicing
+                dtype - numpy data type of the output array, default is the dataset data type
+    Returns:    data  - 3D np.ndarray in size of (len(inds), y1-y0, x1-x0), or
+                        1D np.ndarray in size of (len(inds),) if box is None
+    """
+    inds = np.asarray(inds, dtype=np.int64)
+    if box is None:
+        sel, size = (), ()
+    else:
+        box = _clip_box(box, dset.shape[1], dset.shape[2])
+        sel = np.s_[box[1]:box[3], box[0]:box[2]]
+        size = (box[3] - box[1], box[2] - box[0])
+    data = np.empty((inds.size,) + size, dtype=dtype or dset.dtype)
+    if data.size == 0:
+        return data
+
+    # runs of consecutive indices: start and count
+    breaks = np.flatnonzero(np.diff(inds) != 1) + 1
+    starts = inds[np.r_[0, breaks]]
+    counts = np.diff(np.r_[0, breaks, inds.size])
+
+    # read run by run into the output array
+    k = 0
+    for start, count in zip(starts, counts):
+        dset.read_direct(data, (slice(start, start+count),) + sel, np.s_[k:k+count])
+        k += count
+    return data
+
+
+def _get_written_chunk_num(dset):
+    """Get the number of written (allocated) chunks of each slice in the 1st dimension.
+
+    Chunks are enumerated via H5Dchunk_iter, which is much faster than querying
+    H5Dget_chunk_info for each chunk, with the constant-time chunk indexing.
+
+    Parameters: dset - h5py.Dataset object in 3D
+    Returns:    num  - 1D np.ndarray of int in size of (dset.shape[0],), or
+                       None if the dataset is not chunked or chunk_iter is not supported
+    """
+    if not dset.chunks or not hasattr(dset.id, 'chunk_iter'):
+        return None
+
+    num = np.zeros(dset.shape[0], dtype=np.int64)
+    def count_chunk(info):
+        i0 = info.chunk_offset[0]
+        num[i0:i0+dset.chunks[0]] += 1
+    dset.id.chunk_iter(count_chunk)
+    return num
+
+
+def _nan_moments(data):
+    """Calculate the number, mean and mean square of the valid (non-NaN) values
+    of each slice in the 1st dimension, in one pass over the data.
+
+    Compared with np.nanstd / np.nanmean(np.square()), the NaN mask is computed once,
+    and the sum of squares is accumulated in float64 by np.einsum without the
+    temporary array of squares.
+
+    Parameters: data - 3D np.ndarray in float32/64, NaN values are set to zero in place
+    Returns:    num  - 1D np.ndarray in int64, number of valid values
+                mean - 1D np.ndarray in float64, mean of valid values
+                msq  - 1D np.ndarray in float64, mean square of valid values
+    """
+    data = data.reshape(data.shape[0], -1)
+    nan_flag = np.isnan(data)
+    num = data.shape[1] - np.sum(nan_flag, axis=1)
+    data[nan_flag] = 0.
+
+    dsum = np.sum(data, axis=1, dtype=np.float64)
+    dsq = np.einsum('ij,ij->i', data, data, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = dsum / num
+        msq = dsq / num
+    return num, mean, msq
+
+
+def _get_design_matrix4phase(ind1, ind2, num_date):
+    """Get the design matrix of phase (incidence matrix) from the date indices of ifgrams.
+
+    Parameters: ind1     - 1D np.ndarray of int, index of date1 of each ifgram in the date list
+                ind2     - 1D np.ndarray of int, index of date2 of each ifgram in the date list
+                num_date - int, number of dates
+    Returns:    A        - 2D np.ndarray of float32 in size of (num_ifgram, num_date)
+                ref_ind  - int, index of the default reference date: the common date1
+                           for single reference network, or the 1st date otherwise
+    """
+    num_ifgram = ind1.size
+    rows = np.arange(num_ifgram)
+    A = np.zeros((num_ifgram, num_date), np.float32)
+    A[rows, ind1] = -1
+    A[rows, ind2] = 1
+
+    ref_ind = int(ind1[0]) if np.all(ind1 == ind1[0]) else 0
+    return A, ref_ind
+
+
+@contextmanager
+def _get_file(obj):
+    """Yield the HDF5 file handle of the input stack object in read-only mode.
+
+    The cached handle in obj.f is re-used if the file is already opened, e.g. via the
+    "with" statement or by an outer method, to avoid re-opening the file for every
+    metadata query and read. Otherwise, the file is opened for the block ONLY.
+
+    Parameters: obj - timeseries / geometry / ifgramStack / singleDataset / HDFEOS object
+    Returns:    f   - h5py.File object
+    Examples:   with _get_file(self) as f:
+                    data = f['date'][:]
+    """
+    if obj.f is not None:
+        yield obj.f
+    else:
+        obj.f = _open_h5(obj.file, 'r')
+        try:
+            yield obj.f
+        finally:
+            obj.f.close()
+            obj.f = None
+
+
 
 ################################ timeseries class begin ################################
 class timeseries:
@@ -153,30 +393,45 @@ class timeseries:
     It contains three datasets in root level: date, bperp and timeseries.
 
     File structure: https://mintpy.readthedocs.io/en/latest/api/data_structure/#timeseries
+
+    Examples:   # keep the file open across multiple reads
+                with timeseries('timeseries.h5') as tsobj:
+                    for date_str in tsobj.dateList:
+                        data = tsobj.read(date_str, print_msg=False)
     """
 
     def __init__(self, file=None):
         self.file = file
         self.name = 'timeseries'
+        self.f = None
+        self._opened = False
+
+    def __enter__(self):
+        self.f = _open_h5(self.file, 'r')
+        self.open(print_msg=False)
+        return self
+
+    def __exit__(self, *args):
+        self.close(print_msg=False)
 
     def close(self, print_msg=True):
-        try:
+        if self.f is not None:
             self.f.close()
+            self.f = None
             if print_msg:
                 print(f'close timeseries file: {os.path.basename(self.file)}')
-        except:
-            pass
         return None
 
     def open(self, print_msg=True):
         if print_msg:
             print(f'open {self.name} file: {os.path.basename(self.file)}')
-        self.get_metadata()
-        self.get_size()
-        self.get_date_list()
-        self.numPixel = self.length * self.width
 
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
+            self.get_metadata()
+            self.get_size()
+            self.get_date_list()
+            self.numPixel = self.length * self.width
+
             try:
                 self.pbase = f['bperp'][:]
                 self.pbase -= self.pbase[self.refIndex]
@@ -185,23 +440,29 @@ class timeseries:
 
         # time info
         self.dateFormat = ptime.get_date_str_format(self.dateList[0])
-        self.times = np.array([dt.datetime.strptime(i, self.dateFormat) for i in self.dateList])
+        times = _date_list2datetime64(self.dateList, self.dateFormat)
         # add hh/mm/ss info to the datetime objects
-        if 'T' not in self.dateFormat or all(i.hour==0 and i.minute==0 for i in self.times):
+        if 'T' not in self.dateFormat or np.all(times.astype('datetime64[m]') == times.astype('datetime64[D]')):
             if 'CENTER_LINE_UTC' in self.metadata.keys():
                 utc_sec = float(self.metadata['CENTER_LINE_UTC'])
-                self.times = np.array([i + dt.timedelta(seconds=utc_sec) for i in self.times])
-        self.tbase = np.array([(i.days + i.seconds / (24 * 60 * 60))
-                               for i in (self.times - self.times[self.refIndex])],
-                              dtype=np.float32)
+                times += np.timedelta64(int(round(utc_sec * 1e6)), 'us')
+        self.times = times.astype(object)
+        self.tbase = ((times - times[self.refIndex]) / np.timedelta64(1, 'D')).astype(np.float32)
 
         # list of float for year, 2014.95
-        self.yearList = [i.year + (i.timetuple().tm_yday-1)/365.25 for i in self.times]
+        years = times.astype('datetime64[Y]')
+        yday0 = (times.astype('datetime64[D]') - years).astype(np.int64)
+        self.yearList = (years.astype(np.int64) + 1970 + yday0 / 365.25).tolist()
         self.sliceList = [f'{self.name}-{i}' for i in self.dateList]
+
+        # index of each date, for O(1) lookup in self.read()
+        # reversed to keep the 1st index of duplicated dates as list.index()
+        self._dateIndex = {d: i for i, d in reversed(list(enumerate(self.dateList)))}
+        self._opened = True
         return None
 
     def get_metadata(self):
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             self.metadata = dict(f.attrs)
             dates = f['date'][:]
         for key, value in self.metadata.items():
@@ -211,7 +472,7 @@ class timeseries:
                 self.metadata[key] = value
 
         # ref_date/index
-        dateList = [i.decode('utf8') for i in dates]
+        dateList = _decode_dates(dates).tolist()
         if 'REF_DATE' not in self.metadata.keys():
             self.metadata['REF_DATE'] = dateList[0]
         self.refIndex = dateList.index(self.metadata['REF_DATE'])
@@ -220,13 +481,13 @@ class timeseries:
         return self.metadata
 
     def get_size(self):
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             self.numDate, self.length, self.width = f[self.name].shape[-3:]
         return self.numDate, self.length, self.width
 
     def get_date_list(self):
-        with h5py.File(self.file, 'r') as f:
-            self.dateList = [i.decode('utf8') for i in f['date'][:]]
+        with _get_file(self) as f:
+            self.dateList = _decode_dates(f['date'][:]).tolist()
         return self.dateList
 
     def read(self, datasetName=None, box=None, squeeze=True, print_msg=True):
@@ -244,7 +505,6 @@ class timeseries:
         """
         if print_msg:
             print(f'reading {self.name} data from file: {self.file} ...')
-        self.open(print_msg=False)
 
         # convert input datasetName into list of dates
         if not datasetName or datasetName == 'timeseries':
@@ -253,7 +513,9 @@ class timeseries:
             datasetName = [datasetName]
         datasetName = [i.replace('timeseries', '').replace('-', '') for i in datasetName]
 
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
+            if not self._opened:
+                self.open(print_msg=False)
             ds = f[self.name]
             if isinstance(ds, h5py.Group):  # support for old mintpy files
                 ds = ds[self.name]
@@ -264,36 +526,49 @@ class timeseries:
                 dateFlag[:] = True
             else:
                 for e in datasetName:
-                    dateFlag[self.dateList.index(e)] = True
+                    try:
+                        dateFlag[self._dateIndex[e]] = True
+                    except KeyError:
+                        # same error as list.index() for unknown date
+                        raise ValueError(f"'{e}' is not in list") from None
 
             # Get Index in space/2_3 dimension
             if box is None:
                 box = [0, 0, self.width, self.length]
-            xsize = box[2] - box[0]
-            ysize = box[3] - box[1]
 
             # read
-            num_slice = np.sum(dateFlag)
-            inds = np.where(dateFlag)[0].tolist()
-
-            if num_slice / dateFlag.size < 0.05:
-                # single indexing if only a small fraction is read
-                data = np.zeros((num_slice, ysize, xsize), dtype=ds.dtype)
-                for i, ind in enumerate(inds):
-                    data[i] = ds[ind,
-                                 box[1]:box[3],
-                                 box[0]:box[2]]
-            else:
-                data = ds[:,
-                          box[1]:box[3],
-                          box[0]:box[2]][dateFlag]
+            data = _read_hyperslab(ds, np.where(dateFlag)[0], box)
 
             if squeeze and any(i == 1 for i in data.shape):
                 data = np.squeeze(data)
         return data
 
 
-    def write2hdf5(self, data, outFile=None, dates=None, bperp=None, metadata=None, refFile=None, compression=None):
+    def _read_blocks(self, box=None, max_memory=0.5):
+        """Iterate over the time-series data block by block in time, to limit the memory usage.
+
+        Parameters: box        - tuple of 4 int, (x0, y0, x1, y1) of the area to read
+                    max_memory - float, max memory to use for each block in GB
+        Yields:     i0 / i1    - int, start / end index of the block in time
+                    data       - 3D np.ndarray in size of (i1-i0, y1-y0, x1-x0)
+        """
+        with _get_file(self) as f:
+            if not self._opened:
+                self.open(print_msg=False)
+            ds = f[self.name]
+            if isinstance(ds, h5py.Group):  # support for old mintpy files
+                ds = ds[self.name]
+
+            if box is None:
+                box = (0, 0, self.width, self.length)
+            step = _get_step_size(ds, box=box, max_memory=max_memory)
+            for i0 in range(0, self.numDate, step):
+                i1 = min(i0 + step, self.numDate)
+                yield i0, i1, _read_hyperslab(ds, np.arange(i0, i1), box)
+
+
+    def write2hdf5(self, data, outFile=None, dates=None, bperp=None, metadata=None, refFile=None, compression=None,
+                   chunks=None):
         """
         Parameters: data  : 3D array of float32
                     dates : 1D array/list of string in YYYYMMDD format
@@ -301,7 +576,9 @@ class timeseries:
                     metadata : dict
                     outFile : string
                     refFile : string
-                    compression : string or None
+                    compression : string or None, e.g. lzf, gzip
+                    chunks : tuple of 3 int, True for auto-chunking by h5py, or
+                             None for chunks of (1, 128, 128) for slab-wise access
         Returns: outFile : string
         Examples:
             from mintpy.objects import timeseries
@@ -330,7 +607,8 @@ class timeseries:
                 with h5py.File(refFile, 'r') as rf:
                     compression = rf[TIMESERIES_DSET_NAMES[0]].compression
             refobj.close(print_msg=False)
-        data = np.array(data, dtype=np.float32)
+        # avoid copying the input data if it is already a C-contiguous float32 array
+        data = np.ascontiguousarray(data, dtype=np.float32)
         dates = np.array(dates, dtype=np.bytes_)
         bperp = np.array(bperp, dtype=np.float32)
         metadata = dict(metadata)
@@ -342,17 +620,29 @@ class timeseries:
             os.makedirs(outDir)
             print(f'create directory: {outDir}')
 
+        # chunk size: one acquisition per chunk in time, to match the slab-wise access
+        if chunks is None:
+            chunks = (1, min(data.shape[1], 128), min(data.shape[2], 128))
+
         # 3D dataset - timeseries
         print(f'create timeseries HDF5 file: {outFile} with w mode')
-        with h5py.File(outFile, 'w') as f:
+        with _open_h5(outFile, 'w') as f:
             print(('create dataset /timeseries of {t:<10} in size of {s} '
                    'with compression={c}').format(t=str(data.dtype),
                                                   s=data.shape,
                                                   c=compression))
-            f.create_dataset('timeseries',
-                             data=data,
-                             chunks=True,
-                             compression=compression)
+            dset = f.create_dataset('timeseries',
+                                    shape=data.shape,
+                                    dtype=np.float32,
+                                    chunks=chunks,
+                                    compression=compression)
+
+            # write slab by slab in the chunk-aligned time dimension
+            # directly from the input array without the intermediate copy of h5py
+            step = _get_step_size(dset)
+            for i0 in range(0, data.shape[0], step):
+                i1 = min(i0 + step, data.shape[0])
+                dset.write_direct(data, source_sel=np.s_[i0:i1], dest_sel=np.s_[i0:i1])
 
             # 1D dataset - date / bperp
             print(f'create dataset /dates      of {str(dates.dtype):<10} in size of {dates.shape}')
@@ -366,19 +656,29 @@ class timeseries:
             for key, value in metadata.items():
                 f.attrs[key] = str(value)
         print(f'finished writing to {outFile}')
+
+        # reset the cached file info if overwritten
+        if self.file and os.path.abspath(outFile) == os.path.abspath(self.file):
+            self._opened = False
         return outFile
 
     def timeseries_std(self, maskFile=None, outFile=None):
         """Calculate the standard deviation (STD) for acquisition of time-series,
            output result to a text file.
         """
-        # Calculate STD
-        data = self.read()
         if maskFile:
             mask = singleDataset(maskFile).read()
             print('read mask from file: '+maskFile)
-            data[:, mask == 0] = np.nan
-        self.std = np.nanstd(data, axis=(1, 2))
+
+        # Calculate STD block by block in time
+        self.std = np.zeros(self.get_size()[0]) * np.nan
+        for i0, i1, data in self._read_blocks():
+            if maskFile:
+                data[:, mask == 0] = np.nan
+            _, mean, msq = _nan_moments(data)
+            self.std[i0:i1] = np.sqrt(np.maximum(msq - mean**2, 0.))
+        # in float32 as the input data, to keep the precision in the output text file
+        self.std = self.std.astype(np.float32)
 
         # Write text file
         header = 'Standard Deviation in space for each acquisition of time-series\n'
@@ -406,16 +706,16 @@ class timeseries:
             print('read mask from file: '+maskFile)
             mask = singleDataset(maskFile).read()
 
-        # Calculate RMS one date at a time
+        # Calculate RMS block by block in time
         self.rms = np.zeros(num_date) * np.nan
         print(f'reading {self.name} data from file: {self.file} ...')
         prog_bar = ptime.progressBar(maxValue=num_date)
-        for i in range(num_date):
-            data = self.read(datasetName=f'{date_list[i]}', print_msg=False)
+        for i0, i1, data in self._read_blocks():
             if maskFile and os.path.isfile(maskFile):
-                data[mask == 0] = np.nan
-            self.rms[i] = np.sqrt(np.nanmean(np.square(data), axis=(0, 1)))
-            prog_bar.update(i+1, suffix=f'{i+1}/{num_date}')
+                data[:, mask == 0] = np.nan
+            # round to float32 as the input data, to keep the precision in the output text file
+            self.rms[i0:i1] = np.sqrt(_nan_moments(data)[2]).astype(np.float32)
+            prog_bar.update(i1, suffix=f'{i1}/{num_date}')
         prog_bar.close()
 
         # Write text file
@@ -431,28 +731,46 @@ class timeseries:
         print(f'save timeseries RMS to text file: {outFile}')
         return outFile
 
-    def spatial_average(self, maskFile=None, box=None, reverseMask=False, threshold=None):
-        self.open(print_msg=False)
-        data = self.read(box=box)
+    def spatial_average(self, maskFile=None, box=None, reverseMask=False, threshold=None, max_memory=0.5):
+        """Calculate the spatial average of each acquisition.
+           The data within the box is read in one block if it fits in max_memory (GB),
+           and block by block in time otherwise.
+        """
+        if not self._opened:
+            self.open(print_msg=False)
+        mask = None
         if maskFile and os.path.isfile(maskFile):
             print('read mask from file: '+maskFile)
             mask = singleDataset(maskFile).read(box=box)
-            data[:, mask == int(reverseMask)] = np.nan
 
-        # calculate area ratio if threshold is specified
-        # percentage of pixels with value above the threshold
-        if threshold is not None:
-            data[data > threshold] = 1
-            data[data <= threshold] = 0
+        dmean = np.zeros(self.numDate, dtype=np.float32)
+        for i0, i1, data in self._read_blocks(box=box, max_memory=max_memory):
+            if mask is not None:
+                data[:, mask == int(reverseMask)] = np.nan
 
-        dmean = np.nanmean(data, axis=(1, 2))
+            # calculate area ratio if threshold is specified
+            # percentage of pixels with value above the threshold
+            if threshold is not None:
+                data[data > threshold] = 1
+                data[data <= threshold] = 0
+
+            dmean[i0:i1] = np.nanmean(data, axis=(1, 2))
         return dmean, self.dateList
 
     def temporal_average(self):
         print(f'calculating the temporal average of timeseries file: {self.file}')
-        self.open(print_msg=False)
-        data = self.read(squeeze=False)
-        dmean = np.nanmean(data, axis=0)
+        if not self._opened:
+            self.open(print_msg=False)
+
+        # accumulate the sum and number of valid values block by block in time
+        dsum = np.zeros((self.length, self.width), dtype=np.float64)
+        dnum = np.zeros((self.length, self.width), dtype=np.int32)
+        for i0, i1, data in self._read_blocks():
+            dsum += np.nansum(data, axis=0)
+            dnum += np.sum(~np.isnan(data), axis=0, dtype=np.int32)
+
+        with np.errstate(invalid='ignore'):
+            dmean = (dsum / dnum).astype(np.float32)
         return dmean
 
 
@@ -461,7 +779,8 @@ class timeseries:
 
         # read
         print('reading timeseries data')
-        self.open(print_msg=False)
+        if not self._opened:
+            self.open(print_msg=False)
         ts_data = self.read(print_msg=False)
 
         # calculate
@@ -543,7 +862,8 @@ class timeseries:
 
     def save2bl_list_file(self, out_file='bl_list.txt'):
         """Generate bl_list.txt file from timeseries h5 file."""
-        self.open(print_msg=False)
+        if not self._opened:
+            self.open(print_msg=False)
         date6_list = [i[2:8] for i in self.dateList]
         pbase_list = self.pbase.tolist()
         print(f'write baseline list info to file: {out_file}')
@@ -567,30 +887,40 @@ class geometry:
     def __init__(self, file=None):
         self.file = file
         self.name = 'geometry'
+        self.f = None
+        self._opened = False
+
+    def __enter__(self):
+        self.f = _open_h5(self.file, 'r')
+        self.open(print_msg=False)
+        return self
+
+    def __exit__(self, *args):
+        self.close(print_msg=False)
 
     def close(self, print_msg=True):
-        try:
+        if self.f is not None:
             self.f.close()
+            self.f = None
             if print_msg:
                 print(f'close geometry file: {os.path.basename(self.file)}')
-        except:
-            pass
 
     def open(self, print_msg=True):
         if print_msg:
             print(f'open {self.name} file: {os.path.basename(self.file)}')
-        self.get_metadata()
-        self.get_size()
-        self.numPixel = self.length * self.width
-        self.geocoded = False
-        if 'Y_FIRST' in self.metadata.keys():
-            self.geocoded = True
-
-        with h5py.File(self.file, 'r') as f:
+
+        with _get_file(self) as f:
+            self.get_metadata()
+            self.get_size()
+            self.numPixel = self.length * self.width
+            self.geocoded = False
+            if 'Y_FIRST' in self.metadata.keys():
+                self.geocoded = True
+
             self.datasetNames = [i for i in f.keys() if isinstance(f[i], h5py.Dataset)]
             self.sliceList = list(self.datasetNames)
             if 'bperp' in f.keys():
-                self.dateList = [i.decode('utf8') for i in f['date'][:]]
+                self.dateList = _decode_dates(f['date'][:]).tolist()
                 self.numDate = len(self.dateList)
                 # Update bperp datasetNames
                 try:
@@ -600,9 +930,10 @@ class geometry:
                 self.sliceList += ['bperp-'+d for d in self.dateList]
             else:
                 self.dateList = None
+        self._opened = True
 
     def get_size(self):
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             dsName = [i for i in f.keys() if i in GEOMETRY_DSET_NAMES][0]
             dsShape = f[dsName].shape
             if len(dsShape) == 3:
@@ -612,7 +943,7 @@ class geometry:
         return self.length, self.width
 
     def get_metadata(self):
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             self.metadata = dict(f.attrs)
         for key, value in self.metadata.items():
             try:
@@ -643,16 +974,17 @@ class geometry:
             obj.read(datasetName=['bperp-20161020',
                                   'bperp-20161026'])
         """
-        self.open(print_msg=False)
-        if box is None:
-            box = (0, 0, self.width, self.length)
-
         if datasetName is None:
             datasetName = GEOMETRY_DSET_NAMES[0]
         elif isinstance(datasetName, str):
             datasetName = [datasetName]
 
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
+            if not self._opened:
+                self.open(print_msg=False)
+            if box is None:
+                box = (0, 0, self.width, self.length)
+
             familyName = datasetName[0].split('-')[0]
             ds = f[familyName]
             if print_msg:
@@ -661,7 +993,10 @@ class geometry:
             if len(ds.shape) == 1:
                 data = ds[:]
             elif len(ds.shape) == 2:
-                data = ds[box[1]:box[3], box[0]:box[2]]
+                x0, y0, x1, y1 = _clip_box(box, ds.shape[0], ds.shape[1])
+                data = np.empty((y1 - y0, x1 - x0), dtype=ds.dtype)
+                if data.size > 0:
+                    ds.read_direct(data, np.s_[y0:y1, x0:x1])
             else:
                 # get dateFlag - mark in time/1st dimension
                 dateFlag = np.zeros((ds.shape[0]), dtype=np.bool_)
@@ -673,9 +1008,7 @@ class geometry:
                         dateFlag[self.dateList.index(e)] = True
 
                 # read
-                data = ds[:,
-                          box[1]:box[3],
-                          box[0]:box[2]][dateFlag]
+                data = _read_hyperslab(ds, np.where(dateFlag)[0], box)
 
                 if any(i == 1 for i in data.shape):
                     data = np.squeeze(data)
@@ -694,14 +1027,25 @@ class ifgramStack:
     def __init__(self, file=None):
         self.file = file
         self.name = 'ifgramStack'
+        self.f = None
+        self._opened = False
+        # results depending on dropIfgram, reset in self.open() and self.update_drop_ifgram()
+        self._cache = {}
+
+    def __enter__(self):
+        self.f = _open_h5(self.file, 'r')
+        self.open(print_msg=False)
+        return self
+
+    def __exit__(self, *args):
+        self.close(print_msg=False)
 
     def close(self, print_msg=True):
-        try:
+        if self.f is not None:
             self.f.close()
+            self.f = None
             if print_msg:
                 print(f'close {self.name} file: {os.path.basename(self.file)}')
-        except:
-            pass
 
     def open(self, print_msg=True):
         """
@@ -711,19 +1055,23 @@ class ifgramStack:
         """
         if print_msg:
             print(f'open {self.name} file: {os.path.basename(self.file)}')
-        self.get_metadata()
-        self.get_size()
-        self.read_datetimes()
-        self.numPixel = self.length * self.width
+        self._cache.clear()
 
-        # time info
-        self.date12List = [f'{i}_{j}' for i, j in zip(self.mDates, self.sDates)]
-        self.tbaseIfgram = np.array([i.days + i.seconds / (24 * 60 * 60)
-                                     for i in (self.sTimes - self.mTimes)],
-                                    dtype=np.float32)
+        with _get_file(self) as f:
+            self.get_metadata()
+            self.get_size()
+            self.read_datetimes()
+            self.numPixel = self.length * self.width
+
+            # time info
+            self.date12List = [f'{i}_{j}' for i, j in zip(self.mDates, self.sDates)]
+            # index of each date12, for O(1) lookup in self.read()
+            self._date12Index = {d: i for i, d in reversed(list(enumerate(self.date12List)))}
+            self.tbaseIfgram = ((self._sTimes - self._mTimes) / np.timedelta64(1, 'D')).astype(np.float32)
 
-        with h5py.File(self.file, 'r') as f:
             self.dropIfgram = f['dropIfgram'][:]
+            # sorted index of the kept ifgrams, for integer / hyperslab-run reads
+            self._keepIndex = np.flatnonzero(self.dropIfgram)
             self.pbaseIfgram = f['bperp'][:]
 
             # get existed datasetNames in the order of IFGRAM_DSET_NAMES
@@ -733,14 +1081,19 @@ class ifgramStack:
             self.datasetNames = [i for i in IFGRAM_DSET_NAMES if i in dsNames]
             self.datasetNames += [i for i in dsNames if i not in IFGRAM_DSET_NAMES]
 
-        # Get sliceList for self.read()
-        self.sliceList = []
-        for dsName in self.datasetNames:
-            self.sliceList += [f'{dsName}-{i}' for i in self.date12List]
-
-        # Time in timeseries domain
-        self.dateList = self.get_date_list(dropIfgram=False)
-        self.numDate = len(self.dateList)
+            # Get sliceList for self.read()
+            self.sliceList = []
+            for dsName in self.datasetNames:
+                self.sliceList += [f'{dsName}-{i}' for i in self.date12List]
+
+            # Time in timeseries domain
+            # np.unique returns the sorted unique dates in C
+            self._dateList_full = np.unique(np.concatenate([self.mDates, self.sDates]))
+            # index of date1/2 of each ifgram in the full date list
+            self._date1Index = np.searchsorted(self._dateList_full, self.mDates)
+            self._date2Index = np.searchsorted(self._dateList_full, self.sDates)
+            self.dateList = self._dateList_full.tolist()
+            self.numDate = len(self.dateList)
 
         # Reference pixel
         try:
@@ -756,11 +1109,13 @@ class ifgramStack:
             self.refLat = None
             self.refLon = None
 
+        self._opened = True
+
     def get_metadata(self):
         # read metadata from root level
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             self.metadata = dict(f.attrs)
-            dates = f['date'][:].flatten()
+            dates = f['date'][:].ravel()
 
         # decode metadata
         for key, value in self.metadata.items():
@@ -770,13 +1125,13 @@ class ifgramStack:
                 self.metadata[key] = value
 
         # START/END_DATE
-        dateList = sorted(i.decode('utf8') for i in dates)
-        self.metadata['START_DATE'] = dateList[0]
-        self.metadata['END_DATE'] = dateList[-1]
+        dateList = np.sort(_decode_dates(dates))
+        self.metadata['START_DATE'] = str(dateList[0])
+        self.metadata['END_DATE'] = str(dateList[-1])
         return self.metadata
 
     def get_size(self, dropIfgram=False, datasetName=None):
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             # get default datasetName
             if datasetName is None:
                 datasetName = [i for i in ['unwrapPhase', 'rangeOffset', 'azimuthOffset'] if i in f.keys()][0]
@@ -785,23 +1140,30 @@ class ifgramStack:
             self.numIfgram, self.length, self.width = f[datasetName].shape
 
             # update 1st dimension size
+            # without overwriting self.numIfgram, which is cached for the other methods
+            num_ifgram = self.numIfgram
             if dropIfgram:
-                self.numIfgram = np.sum(f['dropIfgram'][:])
-        return self.numIfgram, self.length, self.width
+                num_ifgram = np.sum(f['dropIfgram'][:])
+        return num_ifgram, self.length, self.width
 
     def read_datetimes(self):
         """Read date1/2 into array of datetime.datetime objects"""
-        with h5py.File(self.file, 'r') as f:
-            dates = f['date'][:]
+        # read into pre-allocated array directly, in one C-level read
+        with _get_file(self) as f:
+            ds = f['date']
+            dates = np.empty(ds.shape, dtype=ds.dtype)
+            ds.read_direct(dates)
 
         # grab the date string format
         self.dateFormat = ptime.get_date_str_format(dates[0, 0])
 
         # convert date from str to datetime.datetime objects
-        self.mDates = np.array([i.decode('utf8') for i in dates[:, 0]])
-        self.sDates = np.array([i.decode('utf8') for i in dates[:, 1]])
-        self.mTimes = np.array([dt.datetime.strptime(i, self.dateFormat) for i in self.mDates])
-        self.sTimes = np.array([dt.datetime.strptime(i, self.dateFormat) for i in self.sDates])
+        self.mDates = _decode_dates(dates[:, 0])
+        self.sDates = _decode_dates(dates[:, 1])
+        self._mTimes = _date_list2datetime64(self.mDates, self.dateFormat)
+        self._sTimes = _date_list2datetime64(self.sDates, self.dateFormat)
+        self.mTimes = self._mTimes.astype(object)
+        self.sTimes = self._sTimes.astype(object)
 
     def read(self, datasetName='unwrapPhase', box=None, print_msg=True, dropIfgram=False):
         """Read 3D dataset with bounding box in space
@@ -828,49 +1190,56 @@ class ifgramStack:
             obj.read(datasetName=['unwrapPhase-20161020_20161026',
                                   'unwrapPhase-20161020_20161101'])
         """
-        self.get_size(dropIfgram=False)
-        date12List = self.get_date12_list(dropIfgram=False)
-
         # convert input datasetName into list
         if datasetName is None:
             datasetName = ['unwrapPhase']
         elif isinstance(datasetName, str):
             datasetName = [datasetName]
 
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
+            if not self._opened:
+                self.open(print_msg=False)
+            date12List = self.date12List
+
             familyName = datasetName[0].split('-')[0]
             ds = f[familyName]
             if print_msg:
                 print(f'reading {familyName} data from file: {self.file} ...')
 
-            # get dateFlag - mark in time/1st dimension
-            dateFlag = np.zeros((self.numIfgram), dtype=np.bool_)
+            # get index in time/1st dimension
             datasetName = [i.replace(familyName, '').replace('-', '') for i in datasetName]
             if any(not i for i in datasetName):
                 if dropIfgram:
-                    dateFlag = f['dropIfgram'][:]
+                    inds = self._keepIndex
                 else:
-                    dateFlag[:] = True
+                    inds = np.arange(len(date12List))
             else:
+                dateFlag = np.zeros((len(date12List)), dtype=np.bool_)
                 for e in datasetName:
-                    dateFlag[date12List.index(e)] = True
+                    try:
+                        dateFlag[self._date12Index[e]] = True
+                    except KeyError:
+                        # same error as list.index() for unknown date
+                        raise ValueError(f"'{e}' is not in list") from None
+                inds = np.flatnonzero(dateFlag)
 
             # get index in space/2-3 dimension
             if box is None:
                 box = (0, 0, self.width, self.length)
 
-            # read
-            data = ds[:,
-                      box[1]:box[3],
-                      box[0]:box[2]][dateFlag]
+            # read: one hyperslab per run of consecutive kept/selected interferograms
+            data = _read_hyperslab(ds, inds, box)
 
             if any(i == 1 for i in data.shape):
                 data = np.squeeze(data)
         return data
 
     def spatial_average(self, datasetName='coherence', maskFile=None, box=None, useMedian=False,
-                        reverseMask=False, threshold=None):
-        """ Calculate the spatial average."""
+                        reverseMask=False, threshold=None, max_memory=0.5):
+        """ Calculate the spatial average.
+            The data within the box is read in one hyperslab if it fits in max_memory (GB),
+            and block by block in the chunk-aligned 1st dimension otherwise.
+        """
         if datasetName is None:
             datasetName = 'coherence'
 
@@ -887,19 +1256,25 @@ class ifgramStack:
             maskFile = None
 
         # calculation
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             dset = f[datasetName]
             numIfgram = dset.shape[0]
             dmean = np.zeros((numIfgram), dtype=np.float32)
+            if box is None:
+                box = (0, 0, dset.shape[2], dset.shape[1])
 
-            prog_bar = ptime.progressBar(maxValue=numIfgram)
-            for i in range(numIfgram):
-                prog_bar.update(i+1, suffix=f'{i+1}/{numIfgram}')
+            # read all ifgrams at once for small box, or
+            # block by block in the chunk-aligned 1st dimension otherwise
+            step = _get_step_size(dset, box=box, max_memory=max_memory)
+            prog_bar = ptime.progressBar(maxValue=numIfgram, print_msg=step < numIfgram)
+            for i0 in range(0, numIfgram, step):
+                i1 = min(i0 + step, numIfgram)
+                prog_bar.update(i1, suffix=f'{i1}/{numIfgram}')
 
                 # read
-                data = dset[i, box[1]:box[3], box[0]:box[2]]
+                data = dset[i0:i1, box[1]:box[3], box[0]:box[2]]
                 if maskFile:
-                    data[mask == int(reverseMask)] = np.nan
+                    data[:, mask == int(reverseMask)] = np.nan
 
                 # ignore ZERO value for coherence
                 if datasetName == 'coherence':
@@ -912,41 +1287,40 @@ class ifgramStack:
                     data[data <= threshold] = 0
 
                 if useMedian:
-                    dmean[i] = np.nanmedian(data)
+                    dmean[i0:i1] = np.nanmedian(data, axis=(1, 2))
                 else:
-                    dmean[i] = np.nanmean(data)
+                    dmean[i0:i1] = np.nanmean(data, axis=(1, 2))
             prog_bar.close()
         return dmean, self.date12List
 
     # Functions considering dropIfgram value
+    # date info is read once in self.open() and cached
     def get_date12_list(self, dropIfgram=True):
-        with h5py.File(self.file, 'r') as f:
-            dates = f['date'][:]
-            if dropIfgram:
-                dates = dates[f['dropIfgram'][:], :]
-        mDates = np.array([i.decode('utf8') for i in dates[:, 0]])
-        sDates = np.array([i.decode('utf8') for i in dates[:, 1]])
-        date12List = [f'{i}_{j}' for i, j in zip(mDates, sDates)]
-        return date12List
+        if not self._opened:
+            self.open(print_msg=False)
+        if not dropIfgram:
+            return list(self.date12List)
+
+        key = ('date12', True)
+        if key not in self._cache:
+            self._cache[key] = np.array(self.date12List)[self.dropIfgram].tolist()
+        return list(self._cache[key])
 
     def get_drop_date12_list(self):
-        with h5py.File(self.file, 'r') as f:
-            dates = f['date'][:]
-            dates = dates[~f['dropIfgram'][:], :]
-        mDates = np.array([i.decode('utf8') for i in dates[:, 0]])
-        sDates = np.array([i.decode('utf8') for i in dates[:, 1]])
-        date12List = [f'{i}_{j}' for i, j in zip(mDates, sDates)]
-        return date12List
+        if not self._opened:
+            self.open(print_msg=False)
+        return np.array(self.date12List)[~self.dropIfgram].tolist()
 
     def get_date_list(self, dropIfgram=False):
-        with h5py.File(self.file, 'r') as f:
-            dates = f['date'][:]
-            if dropIfgram:
-                dates = dates[f['dropIfgram'][:], :]
-        mDates = [i.decode('utf8') for i in dates[:, 0]]
-        sDates = [i.decode('utf8') for i in dates[:, 1]]
-        dateList = sorted(list(set(mDates + sDates)))
-        return dateList
+        if not self._opened:
+            self.open(print_msg=False)
+        if dropIfgram:
+            key = ('date', True)
+            if key not in self._cache:
+                self._cache[key] = np.unique(np.concatenate([self.mDates[self.dropIfgram],
+                                                             self.sDates[self.dropIfgram]]))
+            return self._cache[key].tolist()
+        return self._dateList_full.tolist()
 
     def get_reference_phase(self, unwDatasetName='unwrapPhase', skip_reference=False, dropIfgram=False):
         """Get reference value
@@ -955,7 +1329,8 @@ class ifgramStack:
                     dropIfgram : bool, skip ifgrams marked as dropped or not
         Returns:    ref_phase : 1D np.array in size of (num_ifgram,) in float32
         """
-        self.open(print_msg=False)
+        if not self._opened:
+            self.open(print_msg=False)
         if skip_reference:
             ref_phase = np.zeros(self.get_size(dropIfgram=dropIfgram)[0], np.float32)
             print('skip checking reference pixel info - This is for offset and testing ONLY.')
@@ -969,12 +1344,14 @@ class ifgramStack:
                                   print_msg=False)
         return ref_phase
 
-    def nonzero_mask(self, datasetName=None, print_msg=True, dropIfgram=True):
+    def nonzero_mask(self, datasetName=None, print_msg=True, dropIfgram=True, num_worker=4):
         """Return the common mask of pixels with non-zero value in dataset of all ifgrams.
-           Ignoring dropped ifgrams
+           Ignoring dropped ifgrams.
+           Blocks of ifgrams are read and reduced in parallel by num_worker threads.
         """
-        self.open(print_msg=False)
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
+            if not self._opened:
+                self.open(print_msg=False)
             if datasetName is None:
                 datasetName = [i for i in ['connectComponent', 'unwrapPhase']
                                if i in f.keys()][0]
@@ -985,21 +1362,51 @@ class ifgramStack:
             dropIfgramFlag = np.ones(dset.shape[0], dtype=np.bool_)
             if dropIfgram:
                 dropIfgramFlag = self.dropIfgram
-            num2read = np.sum(dropIfgramFlag)
-            idx2read = np.where(dropIfgramFlag)[0]
-
-            # Loop to save memory usage
-            prog_bar = ptime.progressBar(maxValue=num2read)
-            for i in range(num2read):
-                prog_bar.update(i+1, suffix=f'{i+1}/{num2read}')
-                data = dset[idx2read[i], :, :]
-                mask[data == 0.] = 0
-                mask[np.isnan(data)] = 0
+            numIfgram = dset.shape[0]
+
+            # number of written chunks of each ifgram, to skip reading the unwritten ones,
+            # which are filled with zero / NaN by default
+            chunkNum = None
+            if dset.fillvalue == 0 or np.isnan(dset.fillvalue):
+                chunkNum = _get_written_chunk_num(dset)
+
+            def get_block_mask(i0, i1):
+                """Read one block of ifgrams and return its common mask of non-zero pixels."""
+                flag = dropIfgramFlag[i0:i1]
+                if not np.any(flag):
+                    return None
+
+                if chunkNum is not None and np.all(chunkNum[i0:i1][flag] == 0):
+                    return np.zeros(dset.shape[1:3], dtype=np.bool_)
+
+                data = dset[i0:i1, :, :][flag]
+                # one fused test of non-zero and non-NaN values
+                valid = data != 0.
+                valid &= ~np.isnan(data)
+                return np.all(valid, axis=0)
+
+            # Loop block by block in the chunk-aligned 1st dimension to save memory usage
+            # read the contiguous block and skip the dropped ifgrams in memory
+            # h5py reads are serialized, but overlap with the NumPy reduction in other threads
+            step = _get_step_size(dset, max_memory=0.5/num_worker)
+            i0s = list(range(0, numIfgram, step))
+            i1s = [min(i0 + step, numIfgram) for i0 in i0s]
+
+            prog_bar = ptime.progressBar(maxValue=numIfgram)
+            with ThreadPoolExecutor(max_workers=num_worker) as executor:
+                for i1, block_mask in zip(i1s, executor.map(get_block_mask, i0s, i1s)):
+                    prog_bar.update(i1, suffix=f'{i1}/{numIfgram}')
+                    if block_mask is not None:
+                        mask &= block_mask
             prog_bar.close()
         return mask
 
-    def temporal_average(self, datasetName='coherence', dropIfgram=True, max_memory=4):
-        self.open(print_msg=False)
+    def temporal_average(self, datasetName='coherence', dropIfgram=True, max_memory=4, num_worker=4):
+        """Calculate the temporal average of the given dataset.
+           Blocks of rows are read and averaged in parallel by num_worker threads.
+        """
+        if not self._opened:
+            self.open(print_msg=False)
         if datasetName is None:
             datasetName = 'coherence'
         print(f'calculate the temporal average of {datasetName} in file {self.file} ...')
@@ -1012,14 +1419,15 @@ class ifgramStack:
                 raise Exception('ALL interferograms are marked as dropped, '
                                 'can not calculate temporal average.')
 
-        # temporal baseline for phase
-        # with unit of years (float64 for very short tbase of UAVSAR data)
+        # weight of each pair: phase-to-velocity scale for phase
+        # temporal baseline with unit of years (float64 for very short tbase of UAVSAR data)
+        weight = None
         if 'unwrapPhase' in datasetName:
             phase2range = -1 * float(self.metadata['WAVELENGTH']) / (4.0 * np.pi)
             tbase = np.array(self.tbaseIfgram, dtype=np.float64) / 365.25
-            tbase = tbase[ifgram_flag]
+            weight = (phase2range / tbase[ifgram_flag]).astype(np.float32)
 
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             dset = f[datasetName]
 
             # reference value for phase
@@ -1030,33 +1438,46 @@ class ifgramStack:
                 ref_val = dset[:, self.refY, self.refX][ifgram_flag]
 
             # get step size and number
+            # with up to num_worker blocks in memory at the same time
             ds_size = np.sum(ifgram_flag, dtype=np.int64) * self.length * self.width * 4
-            num_step = int(np.ceil(ds_size * 3 / (max_memory * 1024**3)))
+            num_step = int(np.ceil(ds_size * 3 * num_worker / (max_memory * 1024**3)))
             row_step = int(np.rint(self.length / num_step / 10) * 10)
+            # align with the chunk size in rows, to read and decompress each chunk once
+            if dset.chunks:
+                row_step = max(int(np.rint(row_step / dset.chunks[1])), 1) * dset.chunks[1]
             num_step = int(np.ceil(self.length / row_step))
 
-            # calculate lines by lines
-            dmean = np.zeros(dset.shape[1:3], dtype=np.float32)
-            prog_bar = ptime.progressBar(maxValue=num_step)
-            for i in range(num_step):
-                r0 = i * row_step
-                r1 = min(r0 + row_step, self.length)
-                prog_bar.update(i+1, suffix=f'lines {r1}/{self.length}')
-
+            def calc_block_mean(r0, r1):
+                """Read one block of rows and calculate its temporal average in place."""
                 # read
                 data = dset[:, r0:r1, :][ifgram_flag]
 
-                # referencing / normalizing for phase
-                if 'unwrapPhase' in datasetName:
-                    # spatial referencing
-                    if ref_val is not None:
-                        data -= np.tile(ref_val.reshape(-1, 1, 1), (1, data.shape[1], data.shape[2]))
-                    # phase to phase velocity
-                    for j in range(data.shape[0]):
-                        data[j,:,:] *= (phase2range / tbase[j])
-
-                # use nanmean to better handle NaN values
-                dmean[r0:r1, :] = np.nanmean(data, axis=0)
+                # spatial referencing for phase
+                if ref_val is not None:
+                    data -= ref_val.reshape(-1, 1, 1)
+
+                # weighted mean of the valid (non-NaN) values, i.e. nanmean of weight * data
+                # with the weighting folded into one matrix-vector product
+                nan_flag = np.isnan(data)
+                data[nan_flag] = 0.
+                num_valid = data.shape[0] - np.sum(nan_flag, axis=0, dtype=np.int32)
+                if weight is not None:
+                    data_sum = np.tensordot(weight, data, axes=1)
+                else:
+                    data_sum = np.sum(data, axis=0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    dmean[r0:r1, :] = data_sum / num_valid
+
+            # calculate lines by lines
+            # h5py reads are serialized, but overlap with the NumPy reduction in other threads
+            dmean = np.zeros(dset.shape[1:3], dtype=np.float32)
+            r0s = [i * row_step for i in range(num_step)]
+            r1s = [min(r0 + row_step, self.length) for r0 in r0s]
+
+            prog_bar = ptime.progressBar(maxValue=num_step)
+            with ThreadPoolExecutor(max_workers=num_worker) as executor:
+                for i, _ in enumerate(executor.map(calc_block_mean, r0s, r1s)):
+                    prog_bar.update(i+1, suffix=f'lines {r1s[i]}/{self.length}')
             prog_bar.close()
         return dmean
 
@@ -1080,7 +1501,8 @@ class ifgramStack:
         Returns:    box_list   - list of tuple of 4 int
                     num_box    - int, number of boxes
         """
-        self.open(print_msg=False)
+        if not self._opened:
+            self.open(print_msg=False)
         length = self.length
         width = self.width
 
@@ -1304,48 +1726,49 @@ class ifgramStack:
                     A = ifgramStack.get_design_matrix4timeseries(date12_list, refDate=0)[0] #do not omit the 1st column
         """
         # Date info
-        date12_list = list(date12_list)
-        date1s = [i.split('_')[0] for i in date12_list]
-        date2s = [i.split('_')[1] for i in date12_list]
-        date_list = sorted(list(set(date1s + date2s)))
-        num_ifgram = len(date12_list)
-        num_date = len(date_list)
+        # split date1/2 and get the sorted unique dates with vectorized numpy string operations
+        date12s = np.char.partition(np.asarray(date12_list, dtype=np.str_), '_')
+        date1s, date2s = date12s[:, 0], date12s[:, 2]
+        date_list = np.unique(np.concatenate([date1s, date2s]))
+        num_date = date_list.size
 
         # tbase in the unit of years
         date_format = ptime.get_date_str_format(date_list[0])
-        dates = np.array([dt.datetime.strptime(i, date_format) for i in date_list])
-        tbase = [i.days + i.seconds / (24 * 60 * 60) for i in (dates - dates[0])]
-        tbase = np.array(tbase, dtype=np.float32) / 365.25
+        dates = _date_list2datetime64(date_list, date_format)
+        tbase = ((dates - dates[0]) / np.timedelta64(1, 'D')).astype(np.float32) / 365.25
+
+        # index of date1/2 for each ifgram
+        ind1 = np.searchsorted(date_list, date1s)
+        ind2 = np.searchsorted(date_list, date2s)
 
         # calculate design matrix
         # A for minimizing the residual of phase
         # B for minimizing the residual of phase velocity
-        A = np.zeros((num_ifgram, num_date), np.float32)
-        B = np.zeros((num_ifgram, num_date), np.float32)
-        for i in range(num_ifgram):
-            ind1, ind2 = (date_list.index(d) for d in date12_list[i].split('_'))
-            A[i, ind1] = -1
-            A[i, ind2] = 1
-            # support date12_list with the first date NOT being the earlier date
-            if ind1 < ind2:
-                B[i, ind1:ind2] = tbase[ind1 + 1:ind2 + 1] - tbase[ind1:ind2]
-            else:
-                B[i, ind2:ind1] = tbase[ind2:ind1] - tbase[ind2 + 1:ind1 + 1]
+        A, ref_ind = _get_design_matrix4phase(ind1, ind2, num_date)
+
+        # B: time span between consecutive dates within [date1, date2) of each ifgram
+        # support date12_list with the first date NOT being the earlier date
+        tbase_diff = np.append(np.diff(tbase), np.float32(0))
+        cols = np.arange(num_date)
+        flag = ((cols >= np.minimum(ind1, ind2)[:, np.newaxis])
+                & (cols < np.maximum(ind1, ind2)[:, np.newaxis]))
+        sign = np.where(ind1 < ind2, 1, -1).astype(np.float32)
+        B = np.where(flag, sign[:, np.newaxis] * tbase_diff, 0).astype(np.float32)
 
         # Remove reference date as it can not be resolved
         if refDate != 'no':
             # default refDate
+            # for single   reference network, use the same reference date
+            # for multiple reference network, use the first date
             if refDate is None:
-                # for single   reference network, use the same reference date
-                # for multiple reference network, use the first date
-                if len(set(date1s)) == 1:
-                    refDate = date1s[0]
-                else:
-                    refDate = date_list[0]
+                ind_r = ref_ind
+            elif refDate:
+                ind_r = date_list.tolist().index(refDate)
+            else:
+                ind_r = None
 
             # apply refDate
-            if refDate:
-                ind_r = date_list.index(refDate)
+            if ind_r is not None:
                 A = np.hstack((A[:, 0:ind_r], A[:, (ind_r+1):]))
                 B = B[:, :-1]
 
@@ -1354,19 +1777,64 @@ class ifgramStack:
 
     def get_perp_baseline_timeseries(self, dropIfgram=True):
         """Get spatial perpendicular baseline in timeseries from ifgramStack, ignoring dropped ifgrams"""
+        # re-use the cached result
+        key = ('pbase', bool(dropIfgram))
+        if key in self._cache:
+            return self._cache[key].copy()
+        if not self._opened:
+            self.open(print_msg=False)
+
         # read pbase of interferograms
-        with h5py.File(self.file, 'r') as f:
-            pbaseIfgram = f['bperp'][:]
+        # read into pre-allocated arrays directly, to skip the high-level slicing of h5py
+        # in float32 (converted by HDF5 on read if needed), to keep the solution in float32
+        with _get_file(self) as f:
+            bperp_ds = f['bperp']
             if dropIfgram:
-                pbaseIfgram = pbaseIfgram[f['dropIfgram'][:]]
+                # read the kept ifgrams ONLY, as runs of consecutive indices
+                keep = self._keepIndex
+                pbaseIfgram = _read_hyperslab(bperp_ds, keep, dtype=np.float32)
+            else:
+                keep = slice(None)
+                pbaseIfgram = np.empty(bperp_ds.shape, dtype=np.float32)
+                bperp_ds.read_direct(pbaseIfgram)
+
+        # design matrix from the integer date indices of the ifgrams, without parsing date12 strings
+        # with the date indices re-mapped to the dates of the (kept) ifgrams ONLY
+        num_ifgram = self._date1Index[keep].size
+        date_ind, ind12 = np.unique(np.concatenate([self._date1Index[keep], self._date2Index[keep]]),
+                                    return_inverse=True)
+        A, ref_ind = _get_design_matrix4phase(ind12[:num_ifgram], ind12[num_ifgram:], date_ind.size)
+        # remove the default reference date
+        A = np.delete(A, ref_ind, axis=1)
 
         # estimate pbase of time-series
-        date12List = self.get_date12_list(dropIfgram=dropIfgram)
-        A = self.get_design_matrix4timeseries(date12List)[0]
-        pbaseTimeseries = np.zeros(A.shape[1]+1, dtype=np.float32)
+        pbaseTimeseries = np.empty(A.shape[1]+1, dtype=np.float32)
+        pbaseTimeseries[0] = 0.
         pbaseTimeseries[1:] = np.linalg.lstsq(A, pbaseIfgram, rcond=None)[0]
+        self._cache[key] = pbaseTimeseries.copy()
         return pbaseTimeseries
 
+    def get_perp_baseline_timeseries_batch(self, dropIfgramList=(True, False)):
+        """Get spatial perpendicular baseline in timeseries for multiple dropIfgram options at once.
+
+        The file is opened once for all options, and each result is memoized
+        as in get_perp_baseline_timeseries(), thus, repeated calls are free.
+
+        Parameters: dropIfgramList - list of bool (or None for the default of True),
+                                     ignoring dropped ifgrams or not
+        Returns:    pbaseDict      - dict of 1D np.ndarray in float32 in size of (num_date,),
+                                     with bool of dropIfgram as key
+        Examples:   pbaseDict = stack_obj.get_perp_baseline_timeseries_batch([True, False])
+                    pbase = pbaseDict[True]
+        """
+        pbaseDict = {}
+        with _get_file(self):
+            for dropIfgram in dropIfgramList:
+                dropIfgram = True if dropIfgram is None else bool(dropIfgram)
+                if dropIfgram not in pbaseDict:
+                    pbaseDict[dropIfgram] = self.get_perp_baseline_timeseries(dropIfgram=dropIfgram)
+        return pbaseDict
+
     def update_drop_ifgram(self, date12List2Drop):
         """Update dropIfgram dataset based on input date12List2Drop"""
         if date12List2Drop is None:
@@ -1380,10 +1848,20 @@ class ifgramStack:
             print('The same date12List2Drop / dropIfgram is already marked in the file, skip updating dropIfgram.')
             return
 
+        # release the cached read-only handle, as HDF5 does not allow r+ on an opened file
+        reopen = self.f is not None
+        if reopen:
+            self.close(print_msg=False)
+
         with h5py.File(self.file, 'r+') as f:
             print(f'open file {self.file} with r+ mode')
             print('update HDF5 dataset "/dropIfgram".')
-            f['dropIfgram'][:] = np.array([i not in date12List2Drop for i in date12ListAll], dtype=np.bool_)
+            self.dropIfgram = np.isin(np.asarray(date12ListAll, dtype=np.str_),
+                                      np.asarray(list(date12List2Drop), dtype=np.str_),
+                                      invert=True)
+            f['dropIfgram'][:] = self.dropIfgram
+            self._keepIndex = np.flatnonzero(self.dropIfgram)
+            self._cache.clear()
 
             # update MODIFICATION_TIME for all datasets in IFGRAM_DSET_NAMES
             for dsName in IFGRAM_DSET_NAMES:
@@ -1392,23 +1870,63 @@ class ifgramStack:
                     f[dsName].attrs['MODIFICATION_TIME'] = str(time.time())
                     time.sleep(1)   #to distinguish the modification time of input files
 
+        if reopen:
+            self.f = _open_h5(self.file, 'r')
+
 ################################# ifgramStack class end ################################
 
 
 
 ########################################################################################
 class singleDataset:
+    """
+    Object for file with a single dataset, e.g. mask.h5.
+
+    Examples:   # keep the file open across multiple reads
+                with singleDataset('maskTempCoh.h5') as obj:
+                    for box in box_list:
+                        mask = obj.read(box=box)
+    """
+
     def __init__(self, file=None):
         self.file = file
+        self.f = None
 
-    def read(self, box=None):
-        with h5py.File(self.file, 'r') as f:
-            dsName = list(f.keys())[0]
-            data = f[dsName][:]
+    def __enter__(self):
+        self.open(print_msg=False)
+        return self
+
+    def __exit__(self, *args):
+        self.close(print_msg=False)
 
-        if box is not None:
-            data = data[box[1]:box[3],
-                        box[0]:box[2]]
+    def open(self, print_msg=True):
+        """Open the file in read-only mode and keep the handle for the following reads,
+        until close() is called.
+        """
+        if self.f is None:
+            self.f = _open_h5(self.file, 'r')
+            if print_msg:
+                print(f'open file: {os.path.basename(self.file)}')
+
+    def close(self, print_msg=True):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            if print_msg:
+                print(f'close file: {os.path.basename(self.file)}')
+
+    def read(self, box=None):
+        """Read the 1st dataset within the box.
+        The box is read as a hyperslab by h5py, i.e. only the chunks intersecting the box,
+        thus, the dataset should be chunked with a tile size similar to the typical box.
+        """
+        with _get_file(self) as f:
+            ds = f[list(f.keys())[0]]
+            if box is not None:
+                data = ds[box[1]:box[3],
+                          box[0]:box[2]]
+            else:
+                data = ds[:]
         return data
 
 
@@ -1420,11 +1938,18 @@ class HDFEOS:
     It contains a "timeseries" group and three datasets: date, bperp and timeseries.
 
     File structure: https://mintpy.readthedocs.io/en/latest/hdfeos5/#file_structure
+
+    Examples:   # keep the file open across multiple reads
+                with HDFEOS('S1_IW1_128_0593_0597_20141213_20171221.he5') as obj:
+                    for date_str in obj.dateList:
+                        data = obj.read(f'displacement-{date_str}', print_msg=False)
     """
 
     def __init__(self, file=None):
         self.file = file
         self.name = 'HDFEOS'
+        self.f = None
+        self._opened = False
         self.datasetGroupNameDict = {'displacement'       : 'observation',
                                      'raw'                : 'observation',
                                      'troposphericDelay'  : 'observation',
@@ -1445,26 +1970,34 @@ class HDFEOS:
                                      'bperp'              : 'geometry'
                                     }
 
+    def __enter__(self):
+        self.f = _open_h5(self.file, 'r')
+        self.open(print_msg=False)
+        return self
+
+    def __exit__(self, *args):
+        self.close(print_msg=False)
+
     def close(self, print_msg=True):
-        try:
+        if self.f is not None:
             self.f.close()
+            self.f = None
             if print_msg:
-                print(f'close timeseries file: {os.path.basename(self.file)}')
-        except:
-            pass
+                print(f'close {self.name} file: {os.path.basename(self.file)}')
 
     def open(self, print_msg=True):
         if print_msg:
             print(f'open {self.name} file: {os.path.basename(self.file)}')
-        self.get_metadata()
-        self.length = int(self.metadata['LENGTH'])
-        self.width = int(self.metadata['WIDTH'])
 
-        self.sliceList = []
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
+            self.get_metadata()
+            self.length = int(self.metadata['LENGTH'])
+            self.width = int(self.metadata['WIDTH'])
+
+            self.sliceList = []
             gname = 'HDFEOS/GRIDS/timeseries/observation'
             g = f[gname]
-            self.dateList = [i.decode('utf8') for i in g['date'][:]]
+            self.dateList = _decode_dates(g['date'][:]).tolist()
             self.pbase = g['bperp'][:]
             self.numDate = len(self.dateList)
 
@@ -1476,9 +2009,10 @@ class HDFEOS:
                 for key in g.keys():
                     if isinstance(g[key], h5py.Dataset) and len(g[key].shape) == 2:
                         self.sliceList.append(f'{gname}/{key}')
+        self._opened = True
 
     def get_metadata(self):
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             self.metadata = dict(f.attrs)
             dates = f['HDFEOS/GRIDS/timeseries/observation/date'][:]
         for key, value in self.metadata.items():
@@ -1489,16 +2023,16 @@ class HDFEOS:
         self.metadata['FILE_TYPE'] = self.name
 
         # ref_date/index
-        dateList = [i.decode('utf8') for i in dates]
+        dateList = _decode_dates(dates).tolist()
         if 'REF_DATE' not in self.metadata.keys():
             self.metadata['REF_DATE'] = dateList[0]
         self.refIndex = dateList.index(self.metadata['REF_DATE'])
         return self.metadata
 
     def get_date_list(self):
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
             g = f['HDFEOS/GRIDS/timeseries/observation']
-            self.dateList = [i.decode('utf8') for i in g['date'][:]]
+            self.dateList = _decode_dates(g['date'][:]).tolist()
         return self.dateList
 
     def read(self, datasetName=None, box=None, print_msg=True):
@@ -1515,16 +2049,17 @@ class HDFEOS:
                                           'displacement-20150921'])
                     obj.read(datasetName='incidenceAngle')
         """
-        self.open(print_msg=False)
-        if box is None:
-            box = [0, 0, self.width, self.length]
-
         if datasetName is None:
             datasetName = [TIMESERIES_DSET_NAMES[-1]]
         elif isinstance(datasetName, str):
             datasetName = [datasetName]
 
-        with h5py.File(self.file, 'r') as f:
+        with _get_file(self) as f:
+            if not self._opened:
+                self.open(print_msg=False)
+            if box is None:
+                box = [0, 0, self.width, self.length]
+
             familyName = datasetName[0].split('-')[0]
             groupName = self.datasetGroupNameDict[familyName]
             ds = f[f'HDFEOS/GRIDS/timeseries/{groupName}/{familyName}']
@@ -1545,10 +2080,8 @@ class HDFEOS:
                     for e in datasetName:
                         dateFlag[self.dateList.index(e)] = True
 
-                # read
-                data = ds[:,
-                          box[1]:box[3],
-                          box[0]:box[2]][dateFlag]
+                # read the selected dates within the box ONLY as a native hyperslab
+                data = _read_hyperslab(ds, np.flatnonzero(dateFlag), box)
 
                 # squeeze/shrink dimension whenever it is possible
                 if any(i == 1 for i in data.shape):
@@ -315,12 +315,14 @@ def write_hdf5_file(metadata, out_file, ts_file, tcoh_file, scoh_file, mask_file
         msg += f' of {"float32":<10} in size of {dsShape} with compression={COMPRESSION}'
         print(msg)
 
+        # chunk in ~1 MB spatial tiles of one acquisition each,
+        # to match the acquisition-wise write here and the date/box-wise read in HDFEOS.read()
         dset = group.create_dataset(
             dsName,
             shape=dsShape,
             maxshape=(None, dsShape[1], dsShape[2]),
             dtype=dsDataType,
-            chunks=True,
+            chunks=(1, min(dsShape[1], 512), min(dsShape[2], 512)),
             compression=COMPRESSION,
         )
 